@@ -427,6 +427,7 @@ class Crayon(SimCLRBase):
         anneal_classifier: bool = True, # whether to anneal classifier loss
         s4_kwargs: Optional[dict] = {},
         classifier_hidden_dims: Optional[list[int]] = None,
+        float32_matmul_precision: Optional[str] = None, # e.g. "high" for TF32 GEMMs on Ampere and newer
         ):
 
         super().__init__()
@@ -449,6 +450,7 @@ class Crayon(SimCLRBase):
         self.class_anneal_epochs = class_anneal_epochs
         self.anneal_classifier = anneal_classifier
         self.classifier_hidden_dims = classifier_hidden_dims
+        self.float32_matmul_precision = float32_matmul_precision
 
         self.model = S4Model(d_input=self.num_ifos,
                     length=self.num_timesteps,
@@ -469,6 +471,12 @@ class Crayon(SimCLRBase):
 
         self.save_hyperparameters()
 
+    def setup(self, stage=None):
+        # process wide setting, only applied by the runs that ask for it.
+        # The S4 kernel generation keeps full float32 regardless
+        if self.float32_matmul_precision is not None:
+            torch.set_float32_matmul_precision(self.float32_matmul_precision)
+
     def configure_optimizers(self):
         all_parameters = list(self.parameters())
         general_params = [p for p in all_parameters if not hasattr(p, "_optim")]
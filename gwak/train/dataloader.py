@@ -1,3 +1,4 @@
+import os
 import h5py
 import yaml
 import logging
@@ -338,6 +339,7 @@ class GwakBaseDataloader(pl.LightningDataModule):
         self.glitch_root = glitch_root
         self.data_saving_file = data_saving_file
         self.remake_cache = remake_cache
+        self.base_seed = None # global seed the per-rank DDP seeds derive from
         self.duration = kernel_length + psd_length + fduration
         self.kernel_size = int(sample_rate * self.duration)
         if type(ifos) == list:
@@ -401,6 +403,22 @@ class GwakBaseDataloader(pl.LightningDataModule):
             return all_files[:n_train_files], all_files[n_train_files:n_train_files+n_val_files], all_files[n_train_files+n_val_files:]
 
 
+    def setup(self, stage=None):
+        # windows and injections are sampled from the global RNGs inside
+        # iterable datasets, which DDP cannot shard with a
+        # DistributedSampler: give every rank its own seed instead.
+        # Only a global seed is shared by the ranks, without one every
+        # process already starts from its own random seed. seed_everything
+        # overwrites PL_GLOBAL_SEED, read it once so that a later setup
+        # (fit then test) derives the same per-rank seed
+        if self.base_seed is None:
+            self.base_seed = os.environ.get("PL_GLOBAL_SEED")
+        if self.base_seed is not None and self.trainer is not None and self.trainer.world_size > 1:
+            pl.seed_everything(
+                (int(self.base_seed) + self.trainer.global_rank) % 2**32,
+                workers=bool(int(os.environ.get("PL_SEED_WORKERS", 0))),
+            )
+
     def train_dataloader(self):
 
         dataset = Hdf5TimeSeriesDataset(
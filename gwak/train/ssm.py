@@ -15,11 +15,11 @@ import torch.optim as optim
 import lightning.pytorch as pl
 
 import math
-from typing import Optional, Union
+from typing import List, Optional, Union
 
 import torch
 import torch.nn as nn
-from einops import rearrange, repeat
+from einops import repeat
 from gwak.train.losses import SupervisedSimCLRLoss
 from gwak.train.schedulers import WarmupCosineAnnealingLR
 from gwak.train.plotting import make_corner
@@ -32,6 +32,190 @@ from PIL import Image
 from io import BytesIO
 import shutil
 
+# set TORCHCOMPILE_DISABLE=1 to run S4Model(use_compile=True) eagerly
+TORCHCOMPILE_DISABLE = os.environ.get("TORCHCOMPILE_DISABLE", "0") == "1"
+
+try:
+    from flashfftconv import FlashFFTConv
+except ImportError:
+    FlashFFTConv = None
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+if triton is not None:
+
+    @triton.jit
+    def _glu_linear_kernel(
+        x_ptr, w_ptr, b_ptr, y_ptr,
+        M, H, K,
+        stride_xm, stride_xk,
+        stride_wn, stride_wk,
+        stride_ym, stride_yn,
+        ALLOW_TF32: tl.constexpr,
+        BLOCK_M: tl.constexpr,
+        BLOCK_N: tl.constexpr,
+        BLOCK_K: tl.constexpr,
+    ):
+        """
+        y = (x @ W[:H].T + b[:H]) * sigmoid(x @ W[H:].T + b[H:]),
+        both halves of the projection are accumulated tile-wise
+        and only the gated (M, H) output is written out
+        """
+        pid_m = tl.program_id(0)
+        pid_n = tl.program_id(1)
+        offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+        offs_n = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+        offs_k = tl.arange(0, BLOCK_K)
+        mask_m = offs_m < M
+        # row offsets in int64, M * K can exceed the int32 range
+        offs_m = offs_m.to(tl.int64)
+        mask_n = offs_n < H
+
+        acc_a = tl.zeros((BLOCK_M, BLOCK_N), dtype=tl.float32)
+        acc_b = tl.zeros((BLOCK_M, BLOCK_N), dtype=tl.float32)
+        for k0 in range(0, K, BLOCK_K):
+            k = k0 + offs_k
+            x = tl.load(
+                x_ptr + offs_m[:, None] * stride_xm + k[None, :] * stride_xk,
+                mask=mask_m[:, None] & (k[None, :] < K),
+                other=0.0,
+            )
+            w_offs = offs_n[None, :] * stride_wn + k[:, None] * stride_wk
+            w_mask = mask_n[None, :] & (k[:, None] < K)
+            w_a = tl.load(w_ptr + w_offs, mask=w_mask, other=0.0)
+            w_b = tl.load(w_ptr + H * stride_wn + w_offs, mask=w_mask, other=0.0)
+            if ALLOW_TF32:
+                acc_a = tl.dot(x, w_a, acc_a, input_precision="tf32")
+                acc_b = tl.dot(x, w_b, acc_b, input_precision="tf32")
+            else:
+                acc_a = tl.dot(x, w_a, acc_a, input_precision="ieee")
+                acc_b = tl.dot(x, w_b, acc_b, input_precision="ieee")
+
+        b_a = tl.load(b_ptr + offs_n, mask=mask_n, other=0.0).to(tl.float32)
+        b_b = tl.load(b_ptr + H + offs_n, mask=mask_n, other=0.0).to(tl.float32)
+        a = acc_a + b_a[None, :]
+        g = acc_b + b_b[None, :]
+        y = a * tl.sigmoid(g)
+        tl.store(
+            y_ptr + offs_m[:, None] * stride_ym + offs_n[None, :] * stride_yn,
+            y.to(y_ptr.dtype.element_ty),
+            mask=mask_m[:, None] & mask_n[None, :],
+        )
+
+
+def _glu_linear_triton(x, weight, bias):
+    H = weight.shape[0] // 2
+    K = weight.shape[1]
+    x2d = x.reshape(-1, K)
+    M = x2d.shape[0]
+    y = torch.empty((M, H), device=x.device, dtype=x.dtype)
+
+    BLOCK_M, BLOCK_N, BLOCK_K = 64, 64, 32
+    grid = (triton.cdiv(M, BLOCK_M), triton.cdiv(H, BLOCK_N))
+    _glu_linear_kernel[grid](
+        x2d, weight, bias, y,
+        M, H, K,
+        x2d.stride(0), x2d.stride(1),
+        weight.stride(0), weight.stride(1),
+        y.stride(0), y.stride(1),
+        ALLOW_TF32=torch.backends.cuda.matmul.allow_tf32,
+        BLOCK_M=BLOCK_M,
+        BLOCK_N=BLOCK_N,
+        BLOCK_K=BLOCK_K,
+    )
+    return y.reshape(*x.shape[:-1], H)
+
+
+if triton is not None:
+
+    @triton.jit
+    def _add_layer_norm_kernel(
+        x_ptr, r_ptr, w_ptr, b_ptr, y_ptr,
+        H, eps,
+        BLOCK_H: tl.constexpr,
+    ):
+        """
+        y = layer_norm(x + r) for one row, the sum never
+        leaves registers
+        """
+        row = tl.program_id(0)
+        cols = tl.arange(0, BLOCK_H)
+        mask = cols < H
+        # row offsets in int64, rows * H can exceed the int32 range
+        offs = row.to(tl.int64) * H + cols
+
+        x = tl.load(x_ptr + offs, mask=mask, other=0.0).to(tl.float32)
+        r = tl.load(r_ptr + offs, mask=mask, other=0.0).to(tl.float32)
+        s = x + r
+        mean = tl.sum(s, axis=0) / H
+        d = tl.where(mask, s - mean, 0.0)
+        var = tl.sum(d * d, axis=0) / H
+        rstd = 1.0 / tl.sqrt(var + eps)
+
+        w = tl.load(w_ptr + cols, mask=mask, other=0.0).to(tl.float32)
+        b = tl.load(b_ptr + cols, mask=mask, other=0.0).to(tl.float32)
+        y = d * rstd * w + b
+        tl.store(y_ptr + offs, y.to(y_ptr.dtype.element_ty), mask=mask)
+
+
+def _add_layer_norm_triton(x, residual, weight, bias, eps):
+    H = x.shape[-1]
+    x2d = x.contiguous().view(-1, H)
+    r2d = residual.contiguous().view(-1, H)
+    y = torch.empty_like(x2d)
+    _add_layer_norm_kernel[(x2d.shape[0],)](
+        x2d, r2d, weight, bias, y,
+        H, eps,
+        BLOCK_H=triton.next_power_of_2(H),
+    )
+    return y.view(x.shape)
+
+
+def add_layer_norm(x, residual, weight, bias, eps: float):
+    """
+    F.layer_norm(x + residual) over the last dimension in a single
+    pass: a fused Triton kernel on CUDA, the unfused torch ops otherwise
+    """
+    if triton is None or not x.is_cuda:
+        return F.layer_norm(x + residual, weight.shape, weight, bias, eps)
+    return _add_layer_norm_triton(x, residual, weight, bias, eps)
+
+
+def glu_linear(x, weight, bias):
+    """
+    F.glu(F.linear(x, weight, bias), dim=-1) without materializing
+    the (..., 2H) projection: a single fused Triton kernel on CUDA,
+    the unfused torch ops otherwise
+    """
+    if triton is None or not x.is_cuda:
+        return F.glu(F.linear(x, weight, bias), dim=-1)
+    return _glu_linear_triton(x, weight, bias)
+
+def _fft_block(u, k_f, D, L: int, n: int):
+    """
+    Causal convolution of u (B, L, H) with the kernel spectrum
+    k_f (H, n // 2 + 1) along the sequence dimension, plus the D skip
+    connection. Kept in one function so that a compiled forward
+    fuses the padding, the spectrum product and the skip add
+    around the two FFTs.
+    """
+    # explicit zero padding instead of rfft(n=n), which
+    # inductor does not lower correctly; half precision inputs go
+    # through the FFTs in float32 (no bfloat16 cuFFT)
+    dtype = torch.promote_types(u.dtype, D.dtype)
+    u_f = torch.fft.rfft(
+        F.pad(u.to(torch.promote_types(dtype, torch.float32)), (0, 0, 0, n - L)),
+        dim=-2,
+    )  # (B n/2+1 H)
+    y = torch.fft.irfft(
+        u_f * k_f.transpose(-1, -2), n=n, dim=-2
+    )[..., :L, :]  # (B L H)
+    return (y + u * D).to(dtype)
+
 class DropoutNd(nn.Module):
     def __init__(self, p: float = 0.5, tie=True, transposed=True):
         """
@@ -46,21 +230,22 @@ class DropoutNd(nn.Module):
         self.p = p
         self.tie = tie
         self.transposed = transposed
-        self.binomial = torch.distributions.binomial.Binomial(probs=1 - self.p)
 
     def forward(self, X):
         """X: (batch, dim, lengths...)."""
         if self.training:
             if not self.transposed:
-                X = rearrange(X, "b ... d -> b d ...")
+                X = X.movedim(-1, 1)  # (b ... d) -> (b d ...)
             mask_shape = (
                 X.shape[:2] + (1,) * (X.ndim - 2) if self.tie else X.shape
             )
-            # mask = self.binomial.sample(mask_shape)
-            mask = torch.rand(*mask_shape, device=X.device) < 1.0 - self.p
-            X = X * mask * (1.0 / (1 - self.p))
+            # scaled keep mask in a single kernel
+            mask = torch.empty(
+                mask_shape, device=X.device, dtype=X.dtype
+            ).bernoulli_(1 - self.p).mul_(1.0 / (1 - self.p))
+            X = X * mask
             if not self.transposed:
-                X = rearrange(X, "b d ... -> b ... d")
+                X = X.movedim(1, -1)  # (b d ...) -> (b ... d)
             return X
         return X
 
@@ -75,17 +260,21 @@ class S4DKernel(nn.Module):
         dt_min: float = 0.001,
         dt_max: float = 0.1,
         lr: float = None,
+        dtype: torch.dtype = torch.float32,
     ):
         super().__init__()
 
+        # operand dtype of the Vandermonde contraction, the
+        # discretization runs in float32 (float64 for a double model)
+        self.dtype = dtype
+
         # generate dt
         H = d_model
         log_dt = torch.rand(H) * (
             math.log(dt_max) - math.log(dt_min)
         ) + math.log(dt_min)
 
-        C = torch.randn(H, N // 2, dtype=torch.cfloat)
-        self.C = nn.Parameter(torch.view_as_real(C))
+        self.C = nn.Parameter(torch.randn(H, N // 2, dtype=torch.cfloat))
         self.register("log_dt", log_dt, lr)
 
         log_A_real = torch.log(0.5 * torch.ones(H, N // 2))
@@ -93,27 +282,128 @@ class S4DKernel(nn.Module):
         self.register("log_A_real", log_A_real, lr)
         self.register("A_imag", A_imag, lr)
 
-        Ls = torch.arange(length)
-        self.register_buffer("length", Ls)
+        # positions are generated on the fly, no per-layer arange buffer
+        self.length = length
+
+        # the powers exp(dtA * l) are built from phasors at the
+        # multiples of `chunk` and at the offsets within a chunk,
+        # about 2 sqrt(L) transcendental points per (h, n) for any L
+        self.chunk = math.ceil(math.sqrt(length))
+
+        # channels per Vandermonde slice, bounds the peak memory
+        # of kernel generation to h_chunk * N * L
+        self.h_chunk = 32
 
     def forward(self):
         """
         returns: (..., c, L) where c is number of channels (default 1)
         """
-
-        # Materialize parameters
-        dt = torch.exp(self.log_dt)  # (H)
-        C = torch.view_as_complex(self.C)  # (H N)
-        A = -torch.exp(self.log_A_real) + 1j * self.A_imag  # (H N)
-
-        # Vandermonde multiplication
-        dtA = A * dt.unsqueeze(-1)  # (H N)
-        K = dtA.unsqueeze(-1) * self.length  # (H N L)
-        C = C * (torch.exp(dtA) - 1.0) / A
-        K = 2 * torch.einsum("hn, hnl -> hl", C, torch.exp(K)).real
+        # kernel generation is sensitive to precision, keep it out
+        # of a surrounding bf16 autocast region
+        with torch.autocast(device_type="cuda", enabled=False):
+            return self._kernel()
+
+    def _kernel(self):
+        # Materialize parameters, in real arithmetic
+        dtype = torch.promote_types(self.log_dt.dtype, torch.float32)
+        dt = torch.exp(self.log_dt.to(dtype)).unsqueeze(-1)  # (H 1)
+        Cr, Ci = self.C.real.to(dtype), self.C.imag.to(dtype)  # (H N)
+        Ar = -torch.exp(self.log_A_real.to(dtype))  # (H N)
+        Ai = self.A_imag.to(dtype)  # (H N)
+
+        # dtA = a + i w
+        a, w = Ar * dt, Ai * dt
+
+        # C = C * (exp(dtA) - 1) / A
+        Er = torch.exp(a) * torch.cos(w) - 1.0
+        Ei = torch.exp(a) * torch.sin(w)
+        Nr = Cr * Er - Ci * Ei
+        Ni = Cr * Ei + Ci * Er
+        A2 = Ar * Ar + Ai * Ai
+        Cr = (Nr * Ar + Ni * Ai) / A2
+        Ci = (Ni * Ar - Nr * Ai) / A2
+
+        # Vandermonde multiplication, streamed over channels so that only
+        # an (h_chunk N L) slice of the powers is alive at a time
+        H = a.shape[0]
+        K = []
+        for h0 in range(0, H, self.h_chunk):
+            h1 = h0 + self.h_chunk
+            K.append(self._vandermonde(
+                Cr[h0:h1], Ci[h0:h1], a[h0:h1], w[h0:h1]
+            ))
+        return torch.cat(K, dim=0)  # (H L)
+
+    def _vandermonde(self, Cr, Ci, a, w):
+        """
+        2 * Re(sum_n C[h, n] exp(dtA[h, n] * l)) for one channel chunk
+        in real arithmetic, with C = Cr + i Ci and dtA = a + i w.
+        Only the real part of the sum is formed. returns (h, L)
+        """
+        # exp(dtA * l) = exp(dtA * l0) * exp(dtA * j) with l = l0 + j,
+        # l0 a multiple of `chunk`: transcendentals on h N (L / chunk +
+        # chunk) points and complex multiplies for the rest
+        h, N = a.shape
+        L = self.length
+        j = torch.arange(self.chunk, device=a.device, dtype=a.dtype)
+        l0 = torch.arange(0, L, self.chunk, device=a.device, dtype=a.dtype)
+
+        decay = torch.exp(a.unsqueeze(-1) * j)  # (h N chunk)
+        Wr = decay * torch.cos(w.unsqueeze(-1) * j)
+        Wi = decay * torch.sin(w.unsqueeze(-1) * j)
+        decay = torch.exp(a.unsqueeze(-1) * l0)  # (h N L/chunk)
+        Sr = (decay * torch.cos(w.unsqueeze(-1) * l0)).unsqueeze(-1)
+        Si = (decay * torch.sin(w.unsqueeze(-1) * l0)).unsqueeze(-1)
+        Wr, Wi = Wr.unsqueeze(-2), Wi.unsqueeze(-2)
+
+        # a lowered self.dtype (no complex bfloat16) applies from here on:
+        # only the small phasor factors are cast, the (h N L) products
+        # and the contraction operands are formed directly in it
+        if self.dtype != torch.float32:
+            Sr, Si = Sr.to(self.dtype), Si.to(self.dtype)
+            Wr, Wi = Wr.to(self.dtype), Wi.to(self.dtype)
+            Cr, Ci = Cr.to(self.dtype), Ci.to(self.dtype)
+
+        Pr = (Sr * Wr - Si * Wi).reshape(h, N, -1)[..., :L]  # (h N L)
+        Pi = (Sr * Wi + Si * Wr).reshape(h, N, -1)[..., :L]  # (h N L)
+
+        # Re(C P) = Cr Pr - Ci Pi. Per channel this is a (1 N) x (N L)
+        # product: reduced as multiply-sum rather than a cuBLAS GEMM,
+        # which could run on TF32 under a lowered float32 matmul
+        # precision. The sums accumulate in the dtype of the
+        # discretization, before the two terms cancel
+        K = 2 * (
+            (Cr.unsqueeze(-1) * Pr).sum(1, dtype=a.dtype)
+            - (Ci.unsqueeze(-1) * Pi).sum(1, dtype=a.dtype)
+        )
 
         return K
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store the positions as a "length" buffer
+        state_dict.pop(prefix + "length", None)
+        # and C as a view_as_real (H, N, 2) tensor
+        key = prefix + "C"
+        if key in state_dict and not state_dict[key].is_complex():
+            state_dict[key] = torch.view_as_complex(
+                state_dict[key].contiguous()
+            )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _apply(self, fn, recurse=True):
+        # module.to(real dtype) would keep only the real part of C:
+        # convert complex tensors (C and its grad) through their real
+        # view, complex64 / complex128 are the only complex dtypes used
+        def convert(t):
+            if not t.is_complex():
+                return fn(t)
+            t = fn(torch.view_as_real(t))
+            if t.dtype != torch.float64:
+                t = t.float()
+            return torch.view_as_complex(t)
+
+        return super()._apply(convert, recurse)
+
     def register(self, name, tensor, lr=None):
         """
         Register a tensor with a configurable learning rate
@@ -131,6 +421,11 @@ class S4DKernel(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 class S4D(nn.Module):
+    # the fused FFT convolution is a python-only CUDA module,
+    # the scripted model always falls back to torch.fft
+    __jit_ignored_attributes__ = ["fftconv_fn"]
+    _k_f: Optional[torch.Tensor]
+
     def __init__(
         self,
         d_model: int,
@@ -141,12 +436,30 @@ class S4D(nn.Module):
         dt_min: float = 0.001,
         dt_max: float = 0.1,
         lr: Optional[float] = None,
+        fftconv_fn: Optional[nn.Module] = None,
+        fft_n: Optional[int] = None,
+        kernel_bf16: bool = False,
     ):
         super().__init__()
         self.transposed = transposed
         self.D = nn.Parameter(torch.randn(d_model))
         self.length = length
 
+        # FFT size of the convolution, anything >= 2L - 1 is exact
+        # (e.g. a power of two when that is faster on the device)
+        self.fft_n = fft_n if fft_n is not None else 2 * length
+        if self.fft_n < 2 * length - 1:
+            raise ValueError(
+                "fft_n has to be at least 2 * length - 1 for a causal "
+                "convolution, but got {}".format(self.fft_n)
+            )
+
+        # Optional fused rfft -> multiply -> irfft (FlashFFTConv),
+        # shared between all the layers of an S4Model. It is owned
+        # (registered) by the S4Model only, a plain attribute here.
+        object.__setattr__(self, "fftconv_fn", fftconv_fn)
+        self.use_fftconv = fftconv_fn is not None
+
         # SSM Kernel
         self.kernel = S4DKernel(
             d_model,
@@ -155,6 +468,7 @@ class S4D(nn.Module):
             dt_min=dt_min,
             dt_max=dt_max,
             lr=lr,
+            dtype=torch.bfloat16 if kernel_bf16 else torch.float32,
         )
 
         # Pointwise
@@ -165,38 +479,130 @@ class S4D(nn.Module):
 
         # position-wise output transform to mix features
         self.output_linear = nn.Sequential(
-            nn.Conv1d(d_model, 2 * d_model, kernel_size=1),
-            nn.GLU(dim=-2),
+            nn.Linear(d_model, 2 * d_model),
+            nn.GLU(dim=-1),
         )
 
-    def forward(self, u):
-        """Input and output shape (B, H, L)"""
-        if not self.transposed:
-            u = u.transpose(-1, -2)
+        # The kernel only depends on the parameters: in gradient-free eval
+        # it is computed once and kept until the next train() / load_state_dict
+        # or dtype / device conversion
+        self.register_buffer("_k_f", None, persistent=False)
+        self.register_load_state_dict_post_hook(S4D._reset_kernel_cache)
 
-        # Compute SSM Kernel
-        k = self.kernel()  # (H L)
+    def train(self, mode: bool = True):
+        self._k_f = None
+        return super().train(mode)
 
-        # Convolution
-        k_f = torch.fft.rfft(k, n=2 * self.length)  # (H L)
-        u_f = torch.fft.rfft(u, n=2 * self.length)  # (B H L)
-        y = torch.fft.irfft(u_f * k_f, n=2 * self.length)[
-            ..., : self.length
-        ]  # (B H L)
+    def _apply(self, fn, recurse=True):
+        # a real dtype cast would keep only the real part of the
+        # cached spectrum, recompute it from the converted parameters
+        self._k_f = None
+        return super()._apply(fn, recurse)
 
-        # Compute D term in state space equation
-        # Essentially a skip connection
-        y = y + u * self.D.unsqueeze(-1)
+    @staticmethod
+    def _reset_kernel_cache(module, incompatible_keys):
+        module._k_f = None
 
-        y = self.dropout(self.activation(y))
-        y = self.output_linear(y)
-        if not self.transposed:
+    def kernel_f(self):
+        """
+        returns: the convolution kernel consumed by forward,
+        rfft(k, n=fft_n) of shape (H, fft_n // 2 + 1), or the time domain
+        kernel (H, L) when the fused FFT convolution is used
+        """
+        # only gradient-free eval forwards may reuse the cache,
+        # otherwise the kernel parameters would get no gradients
+        if self.training or torch.is_grad_enabled():
+            return self._kernel_f()
+
+        k_f = self._k_f
+        if k_f is None:
+            if torch.jit.is_scripting():
+                k_f = self._kernel_f()
+            else:
+                k_f = self._cacheable_kernel_f()
+            self._k_f = k_f
+        return k_f
+
+    @torch.jit.unused
+    def _cacheable_kernel_f(self):
+        # a cache filled under inference_mode (Lightning's val/test/predict
+        # loops) would hold an inference tensor, which later eval forwards
+        # with autograd on cannot save for backward
+        with torch.inference_mode(False), torch.no_grad():
+            return self._kernel_f()
+
+    def _kernel_f(self):
+        k = self.kernel()  # (H L)
+        if self.use_fftconv and not torch.jit.is_scripting():
+            return k
+        return torch.fft.rfft(k, n=self.fft_n)
+
+    def forward(self, u, k_f: Optional[torch.Tensor] = None):
+        """
+        Input and output shape (B, H, L), or (B, L, H) if not
+        transposed, k_f is the precomputed output of kernel_f
+        (computed here if None)
+        """
+        # Work channels-last, (B L H), so that the output
+        # transform and the norms need no reshapes
+        if self.transposed:
+            u = u.transpose(-1, -2)
+
+        # Compute SSM Kernel
+        if k_f is None:
+            k_f = self.kernel_f()
+
+        # Convolution along the sequence dimension
+        if self.use_fftconv and not torch.jit.is_scripting():
+            y = self._fftconv(
+                u.transpose(-1, -2), k_f
+            ).transpose(-1, -2)  # (B L H)
+            # Compute D term in state space equation
+            # Essentially a skip connection
+            y = y + u * self.D
+        else:
+            y = _fft_block(u, k_f, self.D, self.length, self.fft_n)  # (B L H)
+
+        # Dropout1d drops whole channels of a (B, H, L) tensor,
+        # the transposes are views
+        y = self.activation(y)
+        y = self.dropout(y.transpose(-1, -2)).transpose(-1, -2)
+        if self.training or torch.is_grad_enabled():
+            # backward needs the full projection anyway
+            y = self.output_linear(y)
+        else:
+            y = self._glu_linear(y)
+        if self.transposed:
             y = y.transpose(-1, -2)
         # Return a dummy state to satisfy this repo's interface,
         # but this can be modified
         return y, None
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # output_linear used to be a Conv1d with a (2H, H, 1) weight
+        key = prefix + "output_linear.0.weight"
+        if key in state_dict and state_dict[key].ndim == 3:
+            state_dict[key] = state_dict[key].squeeze(-1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _glu_linear(self, y):
+        if torch.jit.is_scripting():
+            return self.output_linear(y)
+        linear = self.output_linear[0]
+        return glu_linear(y, linear.weight, linear.bias)
+
+    @torch.jit.unused
+    def _fftconv(self, u, k):
+        """
+        Fused causal FFT convolution, zero-padding to 2L and
+        truncating back to L happens inside the kernel
+        """
+        y = self.fftconv_fn(u.to(torch.bfloat16).contiguous(), k.float())
+        return y.to(u.dtype)
+
 class S4Model(nn.Module):
+    __jit_ignored_attributes__ = ["fftconv", "_compiled_forward"]
+
     def __init__(
         self,
         d_input: int,
@@ -209,11 +615,38 @@ class S4Model(nn.Module):
         prenorm: bool = False,
         dt_min: float = 0.001,
         dt_max: float = 0.1,
-        lr: Optional[float] = None
+        lr: Optional[float] = None,
+        use_flashfftconv: bool = False,
+        use_compile: bool = False,
+        fft_n: Optional[int] = None,
+        kernel_bf16: bool = False
     ):
         super().__init__()
 
         self.prenorm = prenorm
+        self.length = length
+
+        # FFT size shared by all the layers, 2L unless set explicitly
+        self.fft_n = fft_n if fft_n is not None else 2 * length
+
+        # One fused FFT convolution shared by all layers (same seqlen)
+        fftconv_fn = None
+        if use_flashfftconv:
+            if FlashFFTConv is None:
+                raise ImportError(
+                    "use_flashfftconv requires the flashfftconv package"
+                )
+            # FlashFFTConv only supports power of two sizes, any size
+            # >= 2L gives the same causal convolution truncated to L
+            seqlen = 1 << (2 * length - 1).bit_length()
+            fftconv_fn = FlashFFTConv(seqlen, dtype=torch.bfloat16)
+            # its DFT / twiddle matrices are derived from seqlen: keep
+            # them out of the state dict so checkpoints load either way
+            for module in fftconv_fn.modules():
+                for name, buf in list(module.named_buffers(recurse=False)):
+                    module.register_buffer(name, buf, persistent=False)
+        self.fftconv = fftconv_fn
+        self.use_fftconv = fftconv_fn is not None
 
         # Linear encoder (d_input = 1 for grayscale and 3 for RGB)
         self.encoder = nn.Linear(d_input, d_model)
@@ -221,7 +654,7 @@ class S4Model(nn.Module):
         # Stack S4 layers as residual blocks
         self.s4_layers = nn.ModuleList()
         self.norms = nn.ModuleList()
-        self.dropouts = nn.ModuleList()
+        self.dropout_p = dropout
         if lr is not None:
             lr = min(0.001, lr)
         for _ in range(n_layers):
@@ -231,56 +664,113 @@ class S4Model(nn.Module):
                     d_model=d_model,
                     d_state=d_state,
                     dropout=dropout,
-                    transposed=True,
+                    transposed=False,
                     dt_min=dt_min,
                     dt_max=dt_max,
                     lr=lr,
+                    fftconv_fn=fftconv_fn,
+                    fft_n=self.fft_n,
+                    kernel_bf16=kernel_bf16,
                 )
             )
             self.norms.append(nn.LayerNorm(d_model))
-            self.dropouts.append(nn.Dropout1d(dropout))
 
         # Linear decoder
         self.decoder = nn.Linear(d_model, d_output)
 
+        # Fixed shape graph, capture it with CUDA graphs to get rid of
+        # the launch overhead of the many small per-layer kernels.
+        # Kernel generation stays eager (see forward).
+        self.use_compile = use_compile and not TORCHCOMPILE_DISABLE
+        self._compiled_forward = None
+        if self.use_compile:
+            self._compiled_forward = torch.compile(
+                self._forward_impl,
+                mode="reduce-overhead",
+                fullgraph=False,
+                dynamic=False,
+            )
+
+    def kernels_f(self) -> List[torch.Tensor]:
+        """
+        Convolution kernels of all the S4 layers, computed once
+        per forward (cached by the layers in gradient-free eval)
+        """
+        k_fs: List[torch.Tensor] = []
+        if not self.training and not torch.is_grad_enabled():
+            for layer in self.s4_layers:
+                k_fs.append(layer.kernel_f())
+            return k_fs
+
+        for layer in self.s4_layers:
+            k_fs.append(layer.kernel())  # (H L)
+        if self.use_fftconv and not torch.jit.is_scripting():
+            return k_fs
+
+        # one batched rfft for the whole stack instead of one per layer
+        K_f = torch.fft.rfft(
+            torch.stack(k_fs), n=self.fft_n
+        )  # (n_layers H fft_n/2+1)
+        return K_f.unbind(0)
+
     def forward(self, x):
         """
         Input x is shape (B, d_input, L)
         """
-        x = x.transpose(-1, -2)
+        k_fs = self.kernels_f()
+        if self.use_compile and not torch.jit.is_scripting():
+            return self._compiled(x, k_fs)
+        return self._forward_impl(x, k_fs)
+
+    @torch.jit.unused
+    def _compiled(self, x, k_fs: List[torch.Tensor]):
+        # CUDA graph outputs are overwritten by the next replay, callers
+        # like SimCLR keep the first view's embedding across two forwards
+        return self._compiled_forward(x, k_fs).clone()
+
+    def _forward_impl(self, x, k_fs: List[torch.Tensor]):
+        # the only layout change of the forward: (B, d_input, L) is tiny,
+        # a contiguous (B, L, d_input) keeps the encoder on the plain GEMM
+        x = x.transpose(-1, -2).contiguous()
         x = self.encoder(x)  # (B, L, d_input) -> (B, L, d_model)
 
-        x = x.transpose(-1, -2)  # (B, L, d_model) -> (B, d_model, L)
-        for layer, norm, dropout in zip(
-            self.s4_layers, self.norms, self.dropouts
-        ):
+        for i, (layer, norm) in enumerate(zip(self.s4_layers, self.norms)):
             # Each iteration of this loop will map
-            # (B, d_model, L) -> (B, d_model, L)
+            # (B, L, d_model) -> (B, L, d_model)
 
             z = x
             if self.prenorm:
                 # Prenorm
-                z = norm(z.transpose(-1, -2)).transpose(-1, -2)
+                z = norm(z)
 
             # Apply S4 block: we ignore the state input and output
-            z, _ = layer(z)
-
-            # Dropout on the output of the S4 block
-            z = dropout(z)
-
-            # Residual connection
-            x = z + x
+            z, _ = layer(z, k_fs[i])
 
-            if not self.prenorm:
-                # Postnorm
-                x = norm(x.transpose(-1, -2)).transpose(-1, -2)
+            # Channel dropout on the output of the S4 block,
+            # dropout1d wants (B, d_model, L): the transposes are views
+            z = F.dropout1d(
+                z.transpose(-1, -2), p=self.dropout_p, training=self.training
+            ).transpose(-1, -2)
 
-        x = x.transpose(-1, -2)
-
-        # Pooling: average pooling over the sequence length
+            if self.prenorm:
+                # Residual connection
+                x = z + x
+            elif self.training or torch.is_grad_enabled():
+                # Residual connection and postnorm
+                x = norm(z + x)
+            else:
+                x = self._add_norm(z, x, norm.weight, norm.bias, norm.eps)
+
+        # Pooling: average pooling over the sequence length,
+        # contiguous (B, d_model) for the decoder
         x = x.mean(dim=1)
 
         # Decode the outputs
         x = self.decoder(x)  # (B, d_model) -> (B, d_output)
 
-        return x
\ No newline at end of file
+        return x
+
+    def _add_norm(self, z, x, weight, bias, eps: float):
+        if torch.jit.is_scripting():
+            return F.layer_norm(z + x, weight.shape, weight, bias, eps)
+        return add_layer_norm(z, x, weight, bias, eps)
\ No newline at end of file